@@ -4,26 +4,126 @@ Robotic browser.
 
 import re
 import os
-import base64
-import pickle
+import sys
+import codecs
+import json
+import functools
+import hashlib
+import collections
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+from http.cookiejar import Cookie
 
 import requests
 from bs4 import BeautifulSoup
 try:
-    from functools import cached_property
+    import lxml  # noqa: F401
 except ImportError:
-    from werkzeug.utils import cached_property
+    raise ImportError('RoboBrowser requires `lxml` for HTML parsing; '
+                      'install it with `pip install lxml`')
+try:
+    import soupsieve
+except ImportError:
+    soupsieve = None
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 from robobrowser import helpers
 from robobrowser import exceptions
-from robobrowser.compat import urlparse
+from robobrowser.compat import urlparse, OrderedDict
 from robobrowser.forms.form import Form
 from robobrowser.cache import RoboHTTPAdapter
 
 
-_link_ptn = re.compile(r'^(a|button)$', re.I)
-_form_ptn = re.compile(r'^form$', re.I)
+_PARSER = 'lxml'
+_POOL_SIZE = 50
+_TRANSPORTS = ('requests', 'httpx')
+
+_LINK_TAGS = ['a', 'button']
+_FORM_TAG = 'form'
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_css(selector):
+    """Compile a CSS selector once and reuse it across pages."""
+    return soupsieve.compile(selector)
+
+
+@functools.lru_cache(maxsize=None)
+def _lazy_aiohttp():
+    """Import `aiohttp` on first use; it is only needed in async mode."""
+    import aiohttp
+    return aiohttp
+
+
+def _is_httpx_client(session):
+    """Check whether `session` is an `httpx.Client`, without importing httpx
+    when it is not in use.
+    """
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(session, httpx.Client)
+
+
+def _multi_value_dict(pairs):
+    """Fold `(key, value)` pairs into a dict of value lists, as accepted by
+    `httpx` for form data.
+    """
+    rv = {}
+    for key, value in pairs:
+        rv.setdefault(key, []).append(value)
+    return rv
+
+
+@functools.lru_cache(maxsize=1024)
+def _join_url(base, url):
+    """Memoized `urljoin`; pages tend to repeat the same relative links."""
+    return urlparse.urljoin(base, url)
+
+
+def _known_encoding(encoding):
+    """Return `encoding` if Python has a codec for it, else None."""
+    if not encoding:
+        return None
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return None
+    return encoding
+
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def _write_content(response, fp):
+    """Write response body to `fp`. Bodies not yet read (`stream=True`) are
+    copied in chunks rather than loaded into memory first; note that such a
+    response cannot be parsed afterwards.
+
+    """
+    if getattr(response, '_content_consumed', True):
+        fp.write(response.content)
+    else:
+        for chunk in response.iter_content(_CHUNK_SIZE):
+            fp.write(chunk)
+
+
+_COOKIE_FIELDS = (
+    'version', 'name', 'value', 'port', 'port_specified', 'domain',
+    'domain_specified', 'domain_initial_dot', 'path', 'path_specified',
+    'secure', 'expires', 'discard', 'comment', 'comment_url', 'rfc2109',
+)
+
+
+def _cookie_to_dict(cookie):
+    """Dump a `http.cookiejar.Cookie` to a JSON-compatible dict."""
+    rv = {field: getattr(cookie, field) for field in _COOKIE_FIELDS}
+    rv['rest'] = cookie._rest
+    return rv
+
+
+def _cookie_from_dict(data):
+    """Build a `http.cookiejar.Cookie` from `_cookie_to_dict` output."""
+    return Cookie(**data)
 
 
 class RoboState:
@@ -31,21 +131,37 @@ class RoboState:
     lazily parses the response content.
 
     """
+    __slots__ = ('browser', 'response', 'url', '_parsed', '_parsed_url')
 
     def __init__(self, browser, response):
         self.browser = browser
         self.response = response
         self.url = response.url if isinstance(response.url, str) else str(response.url)
+        self._parsed = None
+        self._parsed_url = None
 
-    @cached_property
+    @property
     def parsed(self):
         """Lazily parse response content, using HTML parser specified by the
-        browser.
+        browser. With the browser's `parse_cache_size` enabled, states with
+        identical bodies share one tree, so mutating it in place, e.g. with
+        `decompose`, affects all of them; a tree is also not safe to use
+        from several threads.
         """
-        return BeautifulSoup(
-            self.response.content,
-            features=self.browser.parser,
-        )
+        if self._parsed is None:
+            self._parsed = self.browser._parse(self.response.content)
+        return self._parsed
+
+    @parsed.setter
+    def parsed(self, value):
+        self._parsed = value
+
+    @property
+    def parsed_url(self):
+        """Lazily parse the state URL."""
+        if self._parsed_url is None:
+            self._parsed_url = urlparse.urlparse(self.url)
+        return self._parsed_url
 
 
 class RoboBrowser:
@@ -70,30 +186,63 @@ class RoboBrowser:
     :param int delay: Delay between retries
     :param int multiplier: Delay multiplier between retries
 
+    :param str transport: HTTP client used when no `session` is given;
+        `'requests'` (default) or `'httpx'` for an HTTP/2 `httpx.Client`
+
+    :param int parse_cache_size: Number of parsed trees kept for reuse by
+        states with identical bodies; off (0) by default. Every parsed page
+        is kept, not only repeated ones, and shared trees are not copied,
+        so do not mutate `parsed` in place or use it from several threads
+        when this is enabled
+
     """
     def __init__(self, *, session=None, parser=None, user_agent=None,
                  history=True, timeout=None, allow_redirects=True, cache=False,
                  cache_patterns=None, max_age=None, max_count=None, tries=None,
                  send_referer=True,
-                 multiplier=None, asynchronously=False):
+                 multiplier=None, asynchronously=False, transport='requests',
+                 parse_cache_size=0):
+        if transport not in _TRANSPORTS:
+            raise ValueError('Parameter `transport` must be one of '
+                             '{0}'.format(', '.join(_TRANSPORTS)))
+        if transport == 'httpx' and (session or asynchronously):
+            raise ValueError('Parameter `transport` cannot be combined with '
+                             '`session` or `asynchronously`')
         if session:
             self.session = session
+        elif asynchronously:
+            self.session = RoboBrowser.create_async_session()
+        elif transport == 'httpx':
+            self.session = RoboBrowser.create_httpx_session(retries=tries or 0)
         else:
-            self.session = RoboBrowser.create_async_session() if asynchronously else requests.Session()
+            self.session = requests.Session()
+            if not cache:
+                adapter = HTTPAdapter(pool_connections=_POOL_SIZE,
+                                      pool_maxsize=_POOL_SIZE)
+                for protocol in ['http://', 'https://']:
+                    self.session.mount(protocol, adapter)
+        self._httpx = _is_httpx_client(self.session)
 
         # Add default user agent string
         if user_agent is not None:
             self.session.headers['User-Agent'] = user_agent
 
-        self.parser = parser or 'lxml'
+        self.parser = parser or _PARSER
+        self.parse_cache_size = parse_cache_size
+        self._parse_cache = OrderedDict()
 
-        self.timeout = timeout
-        self.allow_redirects = allow_redirects
+        self._default_send_args = {
+            'timeout': timeout,
+            'allow_redirects': allow_redirects,
+        }
         self.send_referer = send_referer
         self.simple_cookie = None
 
         # Set up caching
-        if cache:
+        if cache and self._httpx:
+            raise ValueError('Caching is not supported with the httpx '
+                             'transport')
+        elif cache:
             adapter = RoboHTTPAdapter(max_age=max_age, max_count=max_count)
             cache_patterns = cache_patterns or ['http://', 'https://']
             for pattern in cache_patterns:
@@ -113,11 +262,11 @@ class RoboBrowser:
             self._maxlen = 1
         else:
             self._maxlen = history
-        self._states = []
+        self._states = collections.deque(maxlen=self._maxlen)
         self._cursor = -1
 
-        # Set up retries
-        if tries:
+        # Set up retries; the httpx transport takes them at construction
+        if tries and not self._httpx:
             retry = Retry(tries, backoff_factor=multiplier)
             for protocol in ['http://', 'https://']:
                 self.session.adapters[protocol].max_retries = retry
@@ -135,9 +284,29 @@ class RoboBrowser:
         await self.session.close()
 
     @staticmethod
-    def create_async_session():
-        import aiohttp
-        return aiohttp.ClientSession()
+    def create_async_session(concurrency=100):
+        """Create an `aiohttp.ClientSession` with a pooled connector shared
+        by all requests of the browser.
+
+        :param int concurrency: Max number of simultaneous connections
+        """
+        aiohttp = _lazy_aiohttp()
+        connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector)
+
+    @staticmethod
+    def create_httpx_session(retries=0):
+        """Create an HTTP/2 `httpx.Client`. Requires `httpx[http2]`.
+
+        :param int retries: Number of retries on connection errors
+        """
+        import httpx
+        transport = httpx.HTTPTransport(
+            http2=True,
+            retries=retries,
+            limits=httpx.Limits(max_connections=100),
+        )
+        return httpx.Client(transport=transport)
 
     @classmethod
     def acreate(cls, session=None, **kwargs) -> 'RoboBrowser':
@@ -145,8 +314,7 @@ class RoboBrowser:
         async with RoboBrowser.acreate() as browser:
             await browser.aopen(url)
         """
-        import aiohttp
-        session = session or aiohttp.ClientSession()
+        session = session or cls.create_async_session()
         return cls(session=session, **kwargs)
 
     @property
@@ -186,14 +354,40 @@ class RoboBrowser:
         except AttributeError:
             raise exceptions.RoboError
 
-    @property
-    def select(self):
-        """See ``BeautifulSoup::select``."""
+    def select(self, selector, limit=None, **kwargs):
+        """See ``BeautifulSoup::select``. Compiled selectors are cached when
+        `soupsieve` is available and no extra options are given.
+
+        """
         try:
-            return self.parsed.select
+            if soupsieve is None or kwargs:
+                return self.parsed.select(selector, limit=limit, **kwargs)
+            return _compile_css(selector).select(self.parsed, limit=limit or 0)
         except AttributeError:
             raise exceptions.RoboError
 
+    def _parse(self, content):
+        """Parse `content`, reusing the tree of an identical body parsed
+        earlier by this browser.
+
+        :param bytes content: Response body
+        :return: BeautifulSoup
+
+        """
+        if not self.parse_cache_size or not isinstance(content, bytes):
+            return BeautifulSoup(content, features=self.parser)
+        key = (self.parser, hashlib.blake2b(content, digest_size=16).digest())
+        try:
+            self._parse_cache.move_to_end(key)
+            return self._parse_cache[key]
+        except KeyError:
+            pass
+        parsed = BeautifulSoup(content, features=self.parser)
+        self._parse_cache[key] = parsed
+        while len(self._parse_cache) > self.parse_cache_size:
+            self._parse_cache.popitem(last=False)
+        return parsed
+
     def _build_url(self, url):
         """Build absolute URL.
 
@@ -201,23 +395,26 @@ class RoboBrowser:
         :return: Full URL
 
         """
-        return urlparse.urljoin(
-            self.url,
-            url
-        )
+        return _join_url(self.url, url)
 
     def set_proxy(self, proxies):
         self.session.proxies = proxies
 
     @property
-    def _default_send_args(self):
-        """
+    def timeout(self):
+        return self._default_send_args['timeout']
 
-        """
-        return {
-            'timeout': self.timeout,
-            'allow_redirects': self.allow_redirects,
-        }
+    @timeout.setter
+    def timeout(self, value):
+        self._default_send_args['timeout'] = value
+
+    @property
+    def allow_redirects(self):
+        return self._default_send_args['allow_redirects']
+
+    @allow_redirects.setter
+    def allow_redirects(self, value):
+        self._default_send_args['allow_redirects'] = value
 
     def _build_send_args(self, **kwargs):
         """Merge optional arguments with defaults.
@@ -225,10 +422,11 @@ class RoboBrowser:
         :param kwargs: Keyword arguments to `Session::send`
 
         """
-        out = {}
-        out.update(self._default_send_args)
-        out.update(kwargs)
-        return out
+        send_args = {**self._default_send_args, **kwargs}
+        if self._httpx:
+            send_args.setdefault(
+                'follow_redirects', send_args.pop('allow_redirects'))
+        return send_args
 
     def open(self, url, method='get', **kwargs):
         """Open a URL.
@@ -253,32 +451,62 @@ class RoboBrowser:
 
         async with getattr(self.session, method)(url, **self._build_send_args(**kwargs)) as resp:
             content = await resp.read()
-            text = await resp.text(encoding)
+            # Decode once here when the charset is known and valid;
+            # otherwise let aiohttp detect it from the body
+            encoding = _known_encoding(encoding or resp.charset)
+            if encoding:
+                text = content.decode(encoding)
+            else:
+                text = await resp.text()
         resp.content = content
         resp.text = text
-        self._update_state(resp)
+        # `_update_state` does not await, so concurrent `aopen` calls cannot
+        # interleave inside it on the event loop
+        return self._update_state(resp)
+
+    async def aopen_many(self, urls, method='get', concurrency=100, **kwargs):
+        """Open many URLs concurrently over the browser's session.
+        Each response is appended to the history as it completes.
+
+        `concurrency` only bounds the requests started here; the session's
+        connection pool has its own limit, set with
+        `create_async_session(concurrency=...)` (100 by default).
+
+        :param list urls: URLs to open
+        :param str method: Optional method; defaults to `'get'`
+        :param int concurrency: Max number of requests in flight
+        :param kwargs: Keyword arguments to `aopen`
+        :return: List of `RoboState`, in the order of `urls`
+
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _open(url):
+            async with semaphore:
+                return await self.aopen(url, method, **kwargs)
+
+        return await asyncio.gather(*[_open(url) for url in urls])
 
     def _update_state(self, response):
         """Update the state of the browser. Create a new state object, and
         append to or overwrite the browser's state history.
 
         :param requests.MockResponse: New response object
+        :return: New `RoboState`
 
         """
         # Clear trailing states
-        self._states = self._states[:self._cursor + 1]
+        while len(self._states) > self._cursor + 1:
+            self._states.pop()
 
-        # Append new state
+        # Append new state; leading states are evicted by the deque's maxlen
         state = RoboState(self, response)
         self._states.append(state)
-        self._cursor += 1
+        self._cursor = len(self._states) - 1
 
-        # Clear leading states
-        if self._maxlen:
-            decrement = len(self._states) - self._maxlen
-            if decrement > 0:
-                self._states = self._states[decrement:]
-                self._cursor -= decrement
+        return state
 
     def _traverse(self, n=1):
         """Traverse state history. Used by `back` and `forward` methods.
@@ -319,7 +547,7 @@ class RoboBrowser:
 
         """
         return helpers.find(
-            self.parsed, _link_ptn, text=text, *args, **kwargs
+            self.parsed, _LINK_TAGS, text=text, *args, **kwargs
         )
 
     def get_links(self, text=None, *args, **kwargs):
@@ -331,7 +559,7 @@ class RoboBrowser:
 
         """
         return helpers.find_all(
-            self.parsed, _link_ptn, text=text, *args, **kwargs
+            self.parsed, _LINK_TAGS, text=text, *args, **kwargs
         )
 
     def get_form(self, id=None, *args, **kwargs):
@@ -343,7 +571,7 @@ class RoboBrowser:
         """
         if id:
             kwargs['id'] = id
-        form = self.find(_form_ptn, *args, **kwargs)
+        form = self.find(_FORM_TAG, *args, **kwargs)
         if form is not None:
             return Form(form)
 
@@ -355,7 +583,7 @@ class RoboBrowser:
         :return: List of BeautifulSoup tags
 
         """
-        forms = self.find_all(_form_ptn, *args, **kwargs)
+        forms = self.find_all(_FORM_TAG, *args, **kwargs)
         return [
             Form(form)
             for form in forms
@@ -388,13 +616,18 @@ class RoboBrowser:
         method = form.method.upper()
 
         if self.url and self.send_referer:
-            kwargs.setdefault('headers', {})
-            kwargs['headers'].setdefault('Referer', self.url)
+            # Copy rather than mutate the caller's headers; theirs win
+            kwargs['headers'] = {
+                'Referer': self.url,
+                **(kwargs.get('headers') or {}),
+            }
 
         # Send request
         url = self._build_url(form.action) or self.url
         payload = form.serialize(submit=submit)
         serialized = payload.to_requests(method)
+        if self._httpx and 'data' in serialized:
+            serialized['data'] = _multi_value_dict(serialized['data'])
         send_args = self._build_send_args(**kwargs)
         send_args.update(serialized)
         response = self.session.request(method, url, **send_args)
@@ -403,21 +636,37 @@ class RoboBrowser:
         self._update_state(response)
 
     # Dash extra methods
+    @property
+    def _cookie_jar(self):
+        """`http.cookiejar.CookieJar` of the session; `httpx.Cookies` only
+        iterates names, so go through its underlying jar.
+        """
+        if self._httpx:
+            return self.session.cookies.jar
+        return self.session.cookies
+
     def get_cookies(self):
         """
         :return: http.cookiejar.Cookie list
         For serialize, example django cache
         """
-        return list(iter(self.session.cookies))
+        return list(iter(self._cookie_jar))
 
     def get_serialized_cookies(self):
-        b = pickle.dumps(self.get_cookies())
-        return base64.b64encode(b).decode()
+        """
+        :return: Cookies serialized as a JSON string
+        """
+        return json.dumps(
+            [_cookie_to_dict(c) for c in self._cookie_jar],
+            separators=(',', ':'),
+        )
 
     def save_cookies_to_file(self, file_path):
         """
         Save pickled cookies to file
         """
+        import pickle
+
         with open(file_path, 'wb') as fp:
             pickle.dump(self.get_cookies(), fp)
 
@@ -426,17 +675,38 @@ class RoboBrowser:
         From serialized, example django cache
         """
         for cookie in cookies:
-            self.session.cookies.set_cookie(cookie)
+            self._cookie_jar.set_cookie(cookie)
 
     def set_serialized_cookies(self, text):
-        b = base64.b64decode(text)
-        cookies = pickle.loads(b)
+        """
+        Load cookies from `get_serialized_cookies` output.
+        Base64-pickled cookies from earlier versions are rejected.
+        """
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise exceptions.RoboError(
+                'Serialized cookies are not JSON; the base64-pickle format '
+                'of earlier versions is no longer supported')
+        error = exceptions.RoboError(
+            'Serialized cookies must be a JSON list of cookie objects')
+        if not isinstance(data, list) or not all(
+                isinstance(item, dict) for item in data):
+            raise error
+        # Build every cookie before touching the jar, so a bad entry does
+        # not leave it partly filled
+        try:
+            cookies = [_cookie_from_dict(item) for item in data]
+        except TypeError:
+            raise error
         self.set_cookies(cookies)
 
     def load_cookies_from_file(self, file_path, fail_silently=True):
         """
         Load unpickled cookies to file
         """
+        import pickle
+
         if not os.path.exists(file_path) and fail_silently:
             return
         with open(file_path, 'rb') as fp:
@@ -447,7 +717,7 @@ class RoboBrowser:
         """
         Get cookies for debug
         """
-        return [c.__dict__ for c in iter(self.session.cookies)]
+        return [c.__dict__ for c in iter(self._cookie_jar)]
 
     def get_cookie_values_as_dicts(self):
         """
@@ -458,18 +728,21 @@ class RoboBrowser:
                 "domain": c.domain,
                 "name": c.name,
                 "value": c.value,
-            } for c in iter(self.session.cookies)
+            } for c in iter(self._cookie_jar)
         ]
 
     def preview(self, suffix='.html'):
         """
-        Preview latest response with GUI web browser
+        Preview latest response with GUI web browser.
+        A response opened with `stream=True` is streamed to the file and
+        its body is consumed: later `take_snapshot`, `preview` or `parsed`
+        calls on it raise `RuntimeError`.
         """
         import tempfile
         import subprocess
 
         f = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        f.write(self.state.response.content)
+        _write_content(self.state.response, f)
         f.close()
 
         # for mac.
@@ -484,12 +757,15 @@ class RoboBrowser:
 
     def take_snapshot(self, file_path):
         """
-        take html snapshot to file
+        take html snapshot to file.
+        A response opened with `stream=True` is streamed to the file and
+        its body is consumed: later `take_snapshot`, `preview` or `parsed`
+        calls on it raise `RuntimeError`.
         """
         with open(file_path, "wb") as fp:
-            fp.write(self.state.response.content)
+            _write_content(self.state.response, fp)
 
-    re_meta_refresh_content_url = re.compile(r'url=(.+)', re.I)
+    re_meta_refresh_content_url = re.compile(r'url=(\S+)', re.I)
 
     re_http_equiv_refresh = re.compile("^refresh$", re.I)
 
@@ -516,7 +792,7 @@ class RoboBrowser:
         """
         Load html force. Overwrite on current state.
         """
-        kwargs.setdefault('features', 'lxml')
+        kwargs.setdefault('features', self.parser)
         parsed = BeautifulSoup(html, **kwargs)
         self.state.parsed = parsed
 
@@ -524,44 +800,52 @@ class RoboBrowser:
         """
         Get parsed current url.
         """
-        return urlparse.urlparse(self.url)
+        return self.state.parsed_url
 
     def get_parsed_query(self, flatten=True, *kwargs):
         """
         Get parsed current url queries
         """
         parsed_url = self.get_parsed_url()
-        qs = urlparse.parse_qs(parsed_url.query, *kwargs)
         if not flatten:
-            return qs
-        return {
-            k: v if len(v) >= 2 else v[0]
-            for k, v in qs.items()
-        }
+            return urlparse.parse_qs(parsed_url.query, *kwargs)
+        # Single pass; only keys that repeat are promoted to lists
+        rv = {}
+        for k, v in urlparse.parse_qsl(parsed_url.query, *kwargs):
+            if k not in rv:
+                rv[k] = v
+            elif isinstance(rv[k], list):
+                rv[k].append(v)
+            else:
+                rv[k] = [rv[k], v]
+        return rv
 
     def reparse(self, decode=True, encoding=None, errors='ignore'):
         """
-        Retry parse content for beautifulsoup
+        Retry parse content for beautifulsoup.
+        With `decode=False` the raw bytes are handed to the parser, using
+        `encoding` as a hint when given instead of having it guess.
         """
-        from bs4 import BeautifulSoup
-        if decode:
-            if encoding:
-                content = self.state.response.content.decode(
-                    encoding, errors=errors)
-            else:
-                content = self.state.response.content.decode(
-                    errors=errors)
+        content = self.state.response.content
+        if not decode:
+            self.state.parsed = BeautifulSoup(
+                content, features=self.parser, from_encoding=encoding)
+            return
+        if encoding:
+            content = content.decode(encoding, errors=errors)
         else:
-            content = self.state.response.content
+            content = content.decode(errors=errors)
         self.state.parsed = BeautifulSoup(content, features=self.parser)
 
     def header_encoding(self):
-        match = re.search(
-            'charset=(.+)',
-            self.response.headers.get('Content-Type', ''),
-            re.IGNORECASE)
-        if match:
-            return match.group(1).lower()
+        """
+        Get charset from the Content-Type response header
+        """
+        message = Message()
+        message['Content-Type'] = self.response.headers.get('Content-Type', '')
+        charset = message.get_param('charset')
+        if charset:
+            return collapse_rfc2231_value(charset).lower()
 
     async def aclose(self):
         try:
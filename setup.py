@@ -10,10 +10,14 @@ from setuptools import find_packages
 
 REQUIREMENTS = [
     'beautifulsoup4>=4.3.2',
+    'lxml',
     'requests>=2.6.0',
     'six>=1.9.0',
     'Werkzeug>=0.10.4',
 ]
+EXTRAS_REQUIREMENTS = {
+    'httpx': ['httpx[http2]'],
+}
 TEST_REQUIREMENTS = [
     'coverage',
     'coveralls',
@@ -58,6 +62,7 @@ setup(
     package_dir={'robobrowser': 'robobrowser'},
     include_package_data=True,
     install_requires=REQUIREMENTS,
+    extras_require=EXTRAS_REQUIREMENTS,
     tests_require=TEST_REQUIREMENTS,
     license='MIT',
     zip_safe=False,
@@ -77,3 +77,68 @@ mock_urls = utils.mock_responses(
         utils.ArgCatcher(responses.GET, 'http://robobrowser.com/page4/'),
     ]
 )
+
+mock_encodings = utils.mock_responses(
+    [
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/shift_jis/',
+            body='<p>ボヘミアン</p>'.encode('shift_jis'),
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/shift_jis_broken/',
+            body=(
+                '<p>ボヘミアン・ラ'.encode('shift_jis') + b'\xff' +
+                'vソディ</p>'.encode('shift_jis')
+            ),
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/utf8/',
+            body='<p>ボヘミアン</p>'.encode('utf-8'),
+        ),
+    ]
+)
+
+mock_headers = utils.mock_responses(
+    [
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/utf8/',
+            content_type='text/html; charset=UTF-8',
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/shift_jis/',
+            content_type='text/html; charset=Shift_JIS; format=flowed',
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/euc_jp/',
+            content_type='text/html; charset="EUC-JP"',
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/no_charset/',
+            content_type='text/html',
+        ),
+    ]
+)
+
+mock_meta_refresh = utils.mock_responses(
+    [
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/refresh/',
+            body=b'''
+                <meta http-equiv="Refresh" content="0;
+                    URL=http://robobrowser.com/login.do;jsessionid=ABC123?next=/">
+            '''
+        ),
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/login.do;jsessionid=ABC123',
+        ),
+    ]
+)
+
+mock_stream = utils.mock_responses(
+    [
+        utils.ArgCatcher(
+            responses.GET, 'http://robobrowser.com/stream/',
+            body=b'<p>sheer heart attack</p>', stream=True,
+        ),
+    ]
+)
@@ -1,16 +1,28 @@
 import aiohttp
+import httpx
 import unittest
 from unittest import mock
 from nose.tools import *  # noqa
 
+import os
 import re
+import json
+import base64
+import pickle
+import sys
+import tempfile
+import subprocess
 import requests
 from bs4 import BeautifulSoup
 
-from robobrowser.browser import RoboBrowser, RoboState
+from robobrowser.browser import RoboBrowser, RoboState, _compile_css
 from robobrowser import exceptions
+from robobrowser.compat import urlparse
 
-from tests.fixtures import mock_links, mock_urls, mock_forms
+from tests.fixtures import (
+    mock_links, mock_urls, mock_forms, mock_encodings, mock_headers,
+    mock_meta_refresh, mock_stream,
+)
 
 
 class TestAsyncBrowser(unittest.IsolatedAsyncioTestCase):
@@ -34,6 +46,65 @@ class TestAsyncBrowser(unittest.IsolatedAsyncioTestCase):
         await browser.aclose()
 
 
+class TestAsyncOpenMany(unittest.IsolatedAsyncioTestCase):
+
+    def _mock_session(self, charset=None):
+        session = mock.MagicMock(closed=False)
+
+        def get(url, **kwargs):
+            resp = mock.MagicMock(url=url, charset=charset)
+            resp.read = mock.AsyncMock(return_value=b'<p>queen</p>')
+            resp.text = session.text = mock.AsyncMock(
+                return_value='<p>queen</p>')
+            resp.__aenter__.return_value = resp
+            return resp
+
+        session.get.side_effect = get
+        return session
+
+    async def test_aopen_many(self):
+        browser = RoboBrowser(session=self._mock_session())
+        urls = [
+            'http://robobrowser.com/page{0}/'.format(idx)
+            for idx in range(5)
+        ]
+        states = await browser.aopen_many(urls, concurrency=2)
+        assert_equal([state.url for state in states], urls)
+        assert_equal(len(browser._states), 5)
+        assert_equal(browser._cursor, 4)
+
+    async def test_aopen_many_respects_history(self):
+        browser = RoboBrowser(session=self._mock_session(), history=2)
+        urls = [
+            'http://robobrowser.com/page{0}/'.format(idx)
+            for idx in range(5)
+        ]
+        await browser.aopen_many(urls)
+        assert_equal(len(browser._states), 2)
+        assert_equal(browser._cursor, 1)
+
+    async def test_aopen_decodes_with_header_charset(self):
+        session = self._mock_session(charset='utf-8')
+        browser = RoboBrowser(session=session)
+        await browser.aopen('http://robobrowser.com/')
+        assert_equal(browser.response.text, '<p>queen</p>')
+        assert_false(session.text.called)
+
+    async def test_aopen_unknown_header_charset(self):
+        session = self._mock_session(charset='utf8mb4')
+        browser = RoboBrowser(session=session)
+        await browser.aopen('http://robobrowser.com/')
+        assert_equal(browser.response.text, '<p>queen</p>')
+        assert_true(session.text.called)
+
+    async def test_aopen_detects_charset(self):
+        session = self._mock_session()
+        browser = RoboBrowser(session=session)
+        await browser.aopen('http://robobrowser.com/')
+        assert_equal(browser.response.text, '<p>queen</p>')
+        assert_true(session.text.called)
+
+
 class TestHeaders(unittest.TestCase):
 
     @mock_links
@@ -202,6 +273,35 @@ class TestForms(unittest.TestCase):
             'deacon=john'
         )
 
+    @mock_forms
+    def test_submit_form_referer(self):
+        self.browser.open('http://robobrowser.com/get_form/')
+        form = self.browser.get_form()
+        self.browser.submit_form(form)
+        assert_equal(
+            self.browser.state.response.request.headers['Referer'],
+            'http://robobrowser.com/get_form/'
+        )
+
+    @mock_forms
+    def test_submit_form_custom_referer(self):
+        self.browser.open('http://robobrowser.com/get_form/')
+        form = self.browser.get_form()
+        self.browser.submit_form(
+            form, headers={'Referer': 'http://queen.com/'})
+        assert_equal(
+            self.browser.state.response.request.headers['Referer'],
+            'http://queen.com/'
+        )
+
+    @mock_forms
+    def test_submit_form_does_not_mutate_headers(self):
+        self.browser.open('http://robobrowser.com/get_form/')
+        form = self.browser.get_form()
+        headers = {'X-Band': 'queen'}
+        self.browser.submit_form(form, headers=headers)
+        assert_equal(headers, {'X-Band': 'queen'})
+
 
 class TestFormsInputNoName(unittest.TestCase):
 
@@ -264,6 +364,16 @@ class TestHistoryInternals(unittest.TestCase):
             assert_equal(len(browser._states), 1)
             assert_equal(browser._cursor, 0)
 
+    @mock_urls
+    def test_state_deque_evicts_oldest(self):
+        browser = RoboBrowser(history=2)
+        for idx in range(1, 5):
+            browser.open('http://robobrowser.com/page{0}/'.format(idx))
+        assert_equal(browser._cursor, 1)
+        assert_equal(browser.url, 'http://robobrowser.com/page4/')
+        browser.back()
+        assert_equal(browser.url, 'http://robobrowser.com/page3/')
+
 
 class TestHistory(unittest.TestCase):
 
@@ -405,6 +515,113 @@ class TestCustomSession(unittest.TestCase):
         )
 
 
+class TestTransport(unittest.TestCase):
+
+    def test_default_pool_size(self):
+        browser = RoboBrowser()
+        adapter = browser.session.get_adapter('https://robobrowser.com/')
+        assert_equal(adapter._pool_maxsize, 50)
+
+    def test_invalid_transport(self):
+        assert_raises(ValueError, RoboBrowser, transport='urllib')
+
+    def test_httpx_session(self):
+        browser = RoboBrowser(transport='httpx', user_agent='freddie')
+        assert_true(isinstance(browser.session, httpx.Client))
+        assert_equal(browser.session.headers['User-Agent'], 'freddie')
+
+    def test_httpx_no_cache(self):
+        assert_raises(ValueError, RoboBrowser, transport='httpx', cache=True)
+
+    def test_httpx_with_session(self):
+        assert_raises(
+            ValueError, RoboBrowser,
+            transport='httpx', session=requests.Session())
+
+    def test_httpx_asynchronously(self):
+        assert_raises(
+            ValueError, RoboBrowser, transport='httpx', asynchronously=True)
+
+    @mock.patch('httpx.Client.request')
+    def test_httpx_send_args(self, mock_request):
+        mock_request.return_value.url = 'http://robobrowser.com/'
+        browser = RoboBrowser(transport='httpx', allow_redirects=False)
+        browser.open('http://robobrowser.com/')
+        kwargs = mock_request.mock_calls[0][2]
+        assert_equal(kwargs, {'timeout': None, 'follow_redirects': False})
+        assert_equal(browser.url, 'http://robobrowser.com/')
+
+    @mock.patch('httpx.Client.request')
+    def test_httpx_call_follow_redirects(self, mock_request):
+        mock_request.return_value.url = 'http://robobrowser.com/'
+        browser = RoboBrowser(transport='httpx', allow_redirects=False)
+        browser.open('http://robobrowser.com/', follow_redirects=True)
+        kwargs = mock_request.mock_calls[0][2]
+        assert_equal(kwargs, {'timeout': None, 'follow_redirects': True})
+
+
+class TestHttpxTransport(unittest.TestCase):
+
+    def _handler(self, request):
+        self.requests.append(request)
+        if request.method == 'POST':
+            return httpx.Response(200, html='<p>submitted</p>')
+        return httpx.Response(
+            200,
+            headers={'Set-Cookie': 'band=queen; Path=/'},
+            html='''
+                <form id="bass" method="post" action="/submit/">
+                    <input name="deacon" value="john" />
+                    <input name="deacon" value="richard" />
+                    <input name="mercury" value="freddie" />
+                </form>
+            ''',
+        )
+
+    def setUp(self):
+        self.requests = []
+        self.session = httpx.Client(
+            transport=httpx.MockTransport(self._handler))
+        self.browser = RoboBrowser(session=self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_detects_httpx_session(self):
+        assert_true(self.browser._httpx)
+        assert_false(RoboBrowser()._httpx)
+
+    def test_submit_form_post(self):
+        self.browser.open('http://robobrowser.com/post_form/')
+        form = self.browser.get_form()
+        self.browser.submit_form(form)
+        assert_equal(self.browser.url, 'http://robobrowser.com/submit/')
+        assert_equal(self.browser.find('p').text, 'submitted')
+        request = self.requests[-1]
+        assert_equal(
+            urlparse.parse_qs(request.content.decode()),
+            {'deacon': ['john', 'richard'], 'mercury': ['freddie']}
+        )
+        assert_equal(
+            request.headers['Referer'], 'http://robobrowser.com/post_form/'
+        )
+
+    def test_cookie_round_trip(self):
+        self.browser.open('http://robobrowser.com/post_form/')
+        assert_equal([c.name for c in self.browser.get_cookies()], ['band'])
+        text = self.browser.get_serialized_cookies()
+
+        with httpx.Client() as session:
+            other = RoboBrowser(session=session)
+            other.set_serialized_cookies(text)
+            assert_equal(session.cookies.get('band'), 'queen')
+            assert_equal(
+                other.get_cookie_values_as_dicts(),
+                [{'domain': 'robobrowser.com', 'name': 'band',
+                  'value': 'queen'}]
+            )
+
+
 class TestTimeout(unittest.TestCase):
 
     @mock.patch('requests.Session.request')
@@ -431,6 +648,15 @@ class TestTimeout(unittest.TestCase):
         kwargs = mock_request.mock_calls[0][2]
         assert_equal(kwargs.get('timeout'), 10)
 
+    @mock.patch('requests.Session.request')
+    def test_set_timeout(self, mock_request):
+        browser = RoboBrowser(timeout=5)
+        browser.timeout = 10
+        browser.open('http://robobrowser.com/')
+        assert_true(mock_request.called)
+        kwargs = mock_request.mock_calls[0][2]
+        assert_equal(kwargs.get('timeout'), 10)
+
 
 class TestAllowRedirects(unittest.TestCase):
 
@@ -457,3 +683,308 @@ class TestAllowRedirects(unittest.TestCase):
         assert_true(mock_request.called)
         kwargs = mock_request.mock_calls[0][2]
         assert_true(kwargs.get('allow_redirects') is False)
+
+
+class TestParser(unittest.TestCase):
+
+    @mock_links
+    def test_default_parser(self):
+        browser = RoboBrowser()
+        assert_equal(browser.parser, 'lxml')
+
+    @mock_links
+    def test_load_html_uses_browser_parser(self):
+        browser = RoboBrowser(parser='html.parser')
+        browser.open('http://robobrowser.com/links/')
+        with mock.patch('robobrowser.browser.BeautifulSoup') as mock_soup:
+            browser.load_html('<p>queen</p>')
+        assert_equal(mock_soup.call_args[1]['features'], 'html.parser')
+
+
+class TestHeaderEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = RoboBrowser()
+
+    @mock_headers
+    def test_charset(self):
+        self.browser.open('http://robobrowser.com/utf8/')
+        assert_equal(self.browser.header_encoding(), 'utf-8')
+
+    @mock_headers
+    def test_charset_with_trailing_params(self):
+        self.browser.open('http://robobrowser.com/shift_jis/')
+        assert_equal(self.browser.header_encoding(), 'shift_jis')
+
+    @mock_headers
+    def test_quoted_charset(self):
+        self.browser.open('http://robobrowser.com/euc_jp/')
+        assert_equal(self.browser.header_encoding(), 'euc-jp')
+
+    @mock_headers
+    def test_no_charset(self):
+        self.browser.open('http://robobrowser.com/no_charset/')
+        assert_equal(self.browser.header_encoding(), None)
+
+
+class TestMetaRefresh(unittest.TestCase):
+
+    @mock_meta_refresh
+    def test_meta_refresh_keeps_path_parameters(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/refresh/')
+        browser.meta_refresh()
+        assert_equal(
+            browser.url,
+            'http://robobrowser.com/login.do;jsessionid=ABC123?next=/'
+        )
+
+
+class TestSelect(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = RoboBrowser()
+
+    @mock_links
+    def test_select(self):
+        self.browser.open('http://robobrowser.com/links/')
+        links = self.browser.select('a.song')
+        assert_equal(len(links), 1)
+        assert_equal(links[0]['href'], '/link2/')
+
+    @mock_links
+    def test_select_limit(self):
+        self.browser.open('http://robobrowser.com/links/')
+        assert_equal(len(self.browser.select('a')), 3)
+        assert_equal(len(self.browser.select('a', limit=2)), 2)
+
+    @mock_links
+    def test_select_reuses_compiled_selector(self):
+        self.browser.open('http://robobrowser.com/links/')
+        _compile_css.cache_clear()
+        self.browser.select('a.nohref')
+        self.browser.select('a.nohref')
+        assert_equal(_compile_css.cache_info().hits, 1)
+
+
+class TestSerializedCookies(unittest.TestCase):
+
+    def test_round_trip(self):
+        browser = RoboBrowser()
+        browser.session.cookies.set(
+            'band', 'queen', domain='robobrowser.com', path='/',
+            rest={'HttpOnly': None})
+        text = browser.get_serialized_cookies()
+        assert_equal(type(text), str)
+
+        other = RoboBrowser()
+        other.set_serialized_cookies(text)
+        cookies = other.get_cookies()
+        assert_equal(len(cookies), 1)
+        assert_equal(cookies[0].name, 'band')
+        assert_equal(cookies[0].value, 'queen')
+        assert_equal(cookies[0].domain, 'robobrowser.com')
+        assert_true(cookies[0].has_nonstandard_attr('HttpOnly'))
+
+    def test_wrong_shape_rejected(self):
+        for text in ['"abc"', '123', 'null', '{}', '[1]', '[{"name": "x"}]']:
+            assert_raises(
+                exceptions.RoboError,
+                RoboBrowser().set_serialized_cookies, text)
+
+    def test_bad_entry_leaves_jar_untouched(self):
+        browser = RoboBrowser()
+        browser.session.cookies.set('band', 'queen', domain='robobrowser.com')
+        good = json.loads(browser.get_serialized_cookies())[0]
+        text = json.dumps([good, {'name': 'broken'}])
+
+        other = RoboBrowser()
+        assert_raises(exceptions.RoboError, other.set_serialized_cookies, text)
+        assert_equal(other.get_cookies(), [])
+
+    def test_legacy_pickle_rejected(self):
+        browser = RoboBrowser()
+        browser.session.cookies.set('band', 'queen')
+        text = base64.b64encode(pickle.dumps(browser.get_cookies())).decode()
+        assert_raises(
+            exceptions.RoboError, RoboBrowser().set_serialized_cookies, text)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = RoboBrowser()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    @mock_links
+    def test_take_snapshot(self):
+        self.browser.open('http://robobrowser.com/links/')
+        self.browser.take_snapshot(self.path)
+        with open(self.path, 'rb') as fp:
+            assert_equal(fp.read(), self.browser.response.content)
+
+    @mock_stream
+    def test_take_snapshot_streamed(self):
+        self.browser.open('http://robobrowser.com/stream/', stream=True)
+        self.browser.take_snapshot(self.path)
+        with open(self.path, 'rb') as fp:
+            assert_equal(fp.read(), b'<p>sheer heart attack</p>')
+
+    @mock_stream
+    def test_take_snapshot_streamed_consumes_body(self):
+        self.browser.open('http://robobrowser.com/stream/', stream=True)
+        self.browser.take_snapshot(self.path)
+        assert_raises(RuntimeError, self.browser.take_snapshot, self.path)
+        assert_raises(RuntimeError, getattr, self.browser, 'parsed')
+
+
+class TestRoboState(unittest.TestCase):
+
+    @mock_links
+    def test_parsed_is_cached(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/links/')
+        assert_true(browser.state.parsed is browser.state.parsed)
+
+    @mock_links
+    def test_parsed_can_be_replaced(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/links/')
+        browser.load_html('<p>queen</p>')
+        assert_equal(browser.find('p').text, 'queen')
+        assert_false(hasattr(browser.state, '__dict__'))
+
+    @mock_urls
+    def test_parsed_shared_across_identical_bodies(self):
+        browser = RoboBrowser(parse_cache_size=4)
+        browser.open('http://robobrowser.com/page1/')
+        first = browser.parsed
+        browser.open('http://robobrowser.com/page1/')
+        assert_true(browser.parsed is first)
+        assert_true(browser.state is not browser._states[0])
+
+    @mock_urls
+    def test_parsed_not_shared_across_browsers(self):
+        browser = RoboBrowser(parse_cache_size=4)
+        browser.open('http://robobrowser.com/page1/')
+        other = RoboBrowser(parse_cache_size=4)
+        other.open('http://robobrowser.com/page1/')
+        assert_true(browser.parsed is not other.parsed)
+
+    @mock_urls
+    def test_parse_cache_disabled_by_default(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/page1/')
+        first = browser.parsed
+        browser.open('http://robobrowser.com/page1/')
+        assert_true(browser.parsed is not first)
+        assert_equal(len(browser._parse_cache), 0)
+
+    def test_parse_cache_is_bounded(self):
+        browser = RoboBrowser(parse_cache_size=3)
+        for idx in range(5):
+            browser._parse('<p>{0}</p>'.format(idx).encode())
+        assert_equal(len(browser._parse_cache), 3)
+
+
+class TestReparse(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = RoboBrowser()
+
+    @mock_encodings
+    def test_reparse_with_encoding(self):
+        self.browser.open('http://robobrowser.com/shift_jis/')
+        self.browser.reparse(encoding='shift_jis')
+        assert_equal(self.browser.find('p').text, 'ボヘミアン')
+
+    @mock_encodings
+    def test_reparse_bytes_with_encoding_hint(self):
+        self.browser.open('http://robobrowser.com/shift_jis/')
+        self.browser.reparse(decode=False, encoding='shift_jis')
+        assert_equal(self.browser.find('p').text, 'ボヘミアン')
+        assert_equal(self.browser.parsed.original_encoding, 'shift_jis')
+
+    @mock_encodings
+    def test_reparse_with_encoding_invalid_bytes(self):
+        self.browser.open('http://robobrowser.com/shift_jis_broken/')
+        self.browser.reparse(encoding='shift_jis')
+        assert_equal(self.browser.find('p').text, 'ボヘミアン・ラvソディ')
+
+    @mock_encodings
+    def test_reparse_with_encoding_invalid_bytes_strict(self):
+        self.browser.open('http://robobrowser.com/shift_jis_broken/')
+        assert_raises(
+            UnicodeDecodeError, self.browser.reparse,
+            encoding='shift_jis', errors='strict')
+
+    @mock_encodings
+    def test_reparse_decode(self):
+        self.browser.open('http://robobrowser.com/utf8/')
+        self.browser.reparse()
+        assert_equal(self.browser.find('p').text, 'ボヘミアン')
+
+
+class TestParsedUrl(unittest.TestCase):
+
+    @mock_urls
+    def test_get_parsed_url(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/page1/?band=queen')
+        parsed = browser.get_parsed_url()
+        assert_equal(parsed.path, '/page1/')
+        assert_equal(parsed.query, 'band=queen')
+        assert_true(browser.get_parsed_url() is parsed)
+
+    @mock_urls
+    def test_parsed_url_follows_state(self):
+        browser = RoboBrowser()
+        browser.open('http://robobrowser.com/page1/')
+        browser.open('http://robobrowser.com/page2/')
+        assert_equal(browser.get_parsed_url().path, '/page2/')
+        browser.back()
+        assert_equal(browser.get_parsed_url().path, '/page1/')
+
+
+class TestParsedQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = RoboBrowser()
+
+    @mock_urls
+    def test_flatten(self):
+        self.browser.open(
+            'http://robobrowser.com/page1/?band=queen&song=a&song=b&song=c')
+        assert_equal(
+            self.browser.get_parsed_query(),
+            {'band': 'queen', 'song': ['a', 'b', 'c']}
+        )
+
+    @mock_urls
+    def test_no_flatten(self):
+        self.browser.open('http://robobrowser.com/page1/?band=queen&song=a')
+        assert_equal(
+            self.browser.get_parsed_query(flatten=False),
+            {'band': ['queen'], 'song': ['a']}
+        )
+
+    @mock_urls
+    def test_blank_values_skipped(self):
+        self.browser.open('http://robobrowser.com/page1/?band=&song=a')
+        assert_equal(self.browser.get_parsed_query(), {'song': 'a'})
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_async_modules_not_imported(self):
+        code = (
+            'import sys, robobrowser; '
+            'print(sorted({"asyncio", "aiohttp", "httpx", "pickle"} '
+            '& set(sys.modules)))'
+        )
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert_equal(out.strip(), b'[]')